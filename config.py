@@ -19,8 +19,19 @@ TILES_DIR.mkdir(exist_ok=True)
 # Tiling settings
 TILE_SIZE = 512
 OVERLAP = 64  # Overlap in pixels. 20-30px mounds -> 64px is safe.
+TILE_FORMAT = "jpg"  # "jpg" (~10x smaller uploads to Gemini) or "png" (lossless)
+JPEG_QUALITY = 90  # Only used for "jpg" tiles
+DEFAULT_EPSG = 32635  # Only used when a map's CRS can't be found (UTM 35N, as the sample maps)
+WRITE_SIDECARS = False  # Also write per-tile world file + .aux.xml (lets QGIS open tiles directly)
+TILING_WORKERS = min(8, os.cpu_count() or 1)  # Threads reading/encoding tiles; reads stop scaling past ~8
 
 # Gemini Settings
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 MODEL_NAME = "gemini-3-pro-preview" # User requested Gemini 3 Pro
 TEST_LIMIT = 5 # Limit number of tiles to process for cost control
+PREFILTER_MIN_PIXELS = 100 # Skip tiles with fewer orange-brown pixels than this (0 disables the pre-filter)
+
+# Rate limiting (see your Gemini quota tier)
+REQUESTS_PER_MINUTE = 6 # Same pace as the old fixed 10s sleep; raise to match your quota
+MAX_CONCURRENT_REQUESTS = 4 # Requests in flight at once
+TILES_PER_REQUEST = 4 # Tiles packed into one multimodal request (1 = one tile per call)
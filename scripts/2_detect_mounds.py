@@ -1,22 +1,41 @@
 
-import json
-import time
+import asyncio
 import os
+import orjson
 from pathlib import Path
 from tqdm import tqdm
 import google.generativeai as genai
 from PIL import Image
-import geojson
-from shapely.geometry import box, mapping
-import rasterio
+import numpy as np
+from aiolimiter import AsyncLimiter
 
 # Adjust python path
 import sys
 from datetime import datetime
 sys.path.append(str(Path(__file__).parent.parent))
-from config import GOOGLE_API_KEY, MODEL_NAME, TILES_DIR, OUTPUTS_DIR, RESULTS_DIR, TILE_SIZE, TEST_LIMIT
+from config import (GOOGLE_API_KEY, MODEL_NAME, TILES_DIR, OUTPUTS_DIR, RESULTS_DIR,
+                    TEST_LIMIT, PREFILTER_MIN_PIXELS, TILES_PER_REQUEST, REQUESTS_PER_MINUTE,
+                    MAX_CONCURRENT_REQUESTS, DEFAULT_EPSG)
+from tile_utils import MIME_TYPES, boxes_to_geo, iter_tiles, load_tile_manifests
 
-def detect_mounds():
+# Orange-brown of the mound symbols in Pillow's HSV space (all channels 0-255; hue ~10-50 degrees)
+MOUND_HSV_MIN = (7, 80, 80)
+MOUND_HSV_MAX = (35, 255, 255)
+
+def has_mound_colours(tile_path):
+    """
+    Cheap pre-filter: does the tile contain enough orange-brown (symbol-coloured) pixels
+    to be worth sending to Gemini? Plain water, forest and blank tiles fail this.
+    Grayscale tiles have no colour to test, so they always pass.
+    """
+    with Image.open(tile_path) as img:
+        if img.mode == "L":
+            return True
+        hsv = np.asarray(img.convert("HSV"))
+    mask = np.all((hsv >= MOUND_HSV_MIN) & (hsv <= MOUND_HSV_MAX), axis=2)
+    return np.count_nonzero(mask) >= PREFILTER_MIN_PIXELS
+
+async def detect_mounds():
     # Configure Gemini
     if not GOOGLE_API_KEY:
         print("Error: GOOGLE_API_KEY not found.")
@@ -46,7 +65,9 @@ def detect_mounds():
         - IGNORE blue wells (circles with blue filling).
         - IGNORE vegetation patterns.
         
-        Output format: return a JSON object with detections using normalized coordinates (0-1000).
+        You may be given several map tiles at once. Treat each tile independently.
+        Output format: return a JSON object with one entry per tile, in the order given,
+        each with detections using normalized coordinates (0-1000) relative to that tile.
         """
     )
 
@@ -58,165 +79,211 @@ def detect_mounds():
     
     filename = f"detections-{current_date}-{sanitized_model}.geojson"
     output_file = RESULTS_DIR / filename
+    # Features are streamed here as they arrive (newline-delimited GeoJSON, one feature per line);
+    # the FeatureCollection in output_file is only assembled once, at the end
+    stream_file = output_file.with_suffix(".geojsonl")
     print(f"Output will be saved to: {output_file}")
     
-    # Load existing results if any to resume
-    features = []
+    # Load existing results if any to resume. Only tile names and a count are kept in
+    # memory; the features themselves stay on disk so long runs use constant memory.
+    feature_count = 0
     processed_tiles = set()
     
-    if output_file.exists():
+    if not stream_file.exists() and output_file.exists():
+        # Run from before streaming: seed the stream with its features
         try:
-            with open(output_file, 'r') as f:
-                data = geojson.load(f)
-                features = data.get("features", [])
-                for feat in features:
-                    if "source_tile" in feat["properties"]:
-                        processed_tiles.add(feat["properties"]["source_tile"])
+            old_features = orjson.loads(output_file.read_bytes()).get("features", [])
+            stream_file.write_bytes(b"".join(orjson.dumps(feat) + b"\n" for feat in old_features))
         except Exception:
             print("Could not read existing GeoJSON, starting fresh.")
-            features = []
+
+    if stream_file.exists():
+        valid_bytes = 0
+        with open(stream_file, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # A run killed mid-write can leave a truncated last line
+                    break
+                feat = orjson.loads(line)
+                valid_bytes += len(line)
+                feature_count += 1
+                if "source_tile" in feat["properties"]:
+                    processed_tiles.add(feat["properties"]["source_tile"])
+        # Drop any partial line so new features start on a fresh one
+        os.truncate(stream_file, valid_bytes)
+    else:
+        stream_file.touch()
 
     # Gather all tiles
-    # We rely on spatial metadata in the files now, so we just look for PNGs
-    all_tiles = []
-    for map_dir in TILES_DIR.iterdir():
-        if map_dir.is_dir():
-            all_tiles.extend(list(map_dir.glob("*.png")))
-    
-    all_tiles = sorted(all_tiles)
+    # We rely on spatial metadata in the manifest now, so we just look for tile images
+    all_tiles = sorted(iter_tiles(TILES_DIR))
     print(f"Found {len(all_tiles)} tiles total.")
     
-    # Filter out already processed tiles
-    tiles_to_process = [t for t in all_tiles if t.name not in processed_tiles]
+    # Geotransform + CRS of every tile, loaded once
+    tile_manifest = load_tile_manifests()
+    
+    # Filter out already processed tiles (only these become Path objects)
+    tiles_to_process = [Path(t) for t in all_tiles if os.path.basename(t) not in processed_tiles]
     
-    # Cost Control: Limit processing
-    if TEST_LIMIT and TEST_LIMIT > 0:
-        print(f"Applying TEST_LIMIT: Only processing {TEST_LIMIT} tiles.")
-        tiles_to_process = tiles_to_process[:TEST_LIMIT]
+    # Tiles with no georeferencing (tiles.parquet or legacy metadata.json) can't be placed
+    missing = [t for t in tiles_to_process if t.name not in tile_manifest]
+    if missing:
+        print(f"Skipping {len(missing)} tiles with no tiles.parquet/metadata.json entry; re-run preprocess_tiling.py")
+        tiles_to_process = [t for t in tiles_to_process if t.name in tile_manifest]
+
+    test_limit = TEST_LIMIT if TEST_LIMIT and TEST_LIMIT > 0 else None
+
+    # Colour pre-filter (decoding is CPU work, so keep it off the event loop).
+    # With a TEST_LIMIT, tiles are checked a limit's worth at a time until enough pass,
+    # rather than decoding every tile of the run
+    if PREFILTER_MIN_PIXELS:
+        chunk = test_limit or max(len(tiles_to_process), 1)
+        kept = []
+        skipped = 0
+        for i in range(0, len(tiles_to_process), chunk):
+            candidates = tiles_to_process[i:i + chunk]
+            keep = await asyncio.gather(*(asyncio.to_thread(has_mound_colours, t) for t in candidates))
+            skipped += keep.count(False)
+            kept.extend(t for t, k in zip(candidates, keep) if k)
+            if test_limit and len(kept) >= test_limit:
+                break
+        tiles_to_process = kept
+        if skipped:
+            print(f"Pre-filter skipped {skipped} tiles with no mound-coloured pixels.")
+
+    # Cost Control: Limit processing (after filtering, so skipped tiles don't use up the limit)
+    if test_limit:
+        print(f"Applying TEST_LIMIT: Only processing {test_limit} tiles.")
+        tiles_to_process = tiles_to_process[:test_limit]
 
     print(f"Processing {len(tiles_to_process)} new tiles...")
 
     prompt = """
-    Look at this Soviet map tile. 
-    Identify the bounding boxes of all 'Burial Mound' symbols.
+    Identify the bounding boxes of all 'Burial Mound' symbols in each tile.
     
-    Return a JSON object in this format (use normalized coordinates 0-1000):
+    Return a JSON object in this format, with one entry per tile in the order given
+    (use normalized coordinates 0-1000, relative to that tile):
     {
-        "detections": [
+        "tiles": [
             {
-                "box_2d": [ymin, xmin, ymax, xmax], 
-                "label": "mound", 
-                "reasoning": "Brief explanation"
+                "tile_idx": 0,
+                "detections": [
+                    {
+                        "box_2d": [ymin, xmin, ymax, xmax], 
+                        "label": "mound", 
+                        "reasoning": "Brief explanation"
+                    }
+                ]
             }
         ]
     }
     """
 
-    save_frequency = 5 
-    
-    for i, tile_path in enumerate(tqdm(tiles_to_process)):
-        filename = tile_path.name
-        
+    # CRS of the source maps (as recorded in the manifest); updated per tile as detections arrive
+    last_epsg = next((epsg for _, epsg in tile_manifest.values() if epsg), None)
+
+    # Requests are dispatched concurrently: the semaphore bounds in-flight calls,
+    # the limiter keeps us within the per-minute quota (replaces the fixed sleep).
+    limiter = AsyncLimiter(REQUESTS_PER_MINUTE, 60)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    progress = tqdm(total=len(tiles_to_process))
+
+    async def process_batch(batch):
+        nonlocal feature_count, last_epsg
+        names = ", ".join(t.name for t in batch)
+
         try:
-            img = Image.open(tile_path)
-            
-            # API Call
-            try:
-                response = model.generate_content([prompt, img])
-            except Exception as e:
-                print(f"API Error for {filename}: {e}")
-                time.sleep(20) # Backoff
-                continue
+            batch_prompt = f"Look at these {len(batch)} Soviet map tiles, numbered 0 to {len(batch) - 1} in order.\n" + prompt
+
+            # API Call (several tiles per request amortises latency and the system instruction)
+            async with semaphore:
+                # Raw file bytes: no decode here and no re-encode in the SDK. Read only once
+                # this batch holds a slot, so at most MAX_CONCURRENT_REQUESTS batches are in memory
+                images = [{"mime_type": MIME_TYPES[t.suffix], "data": t.read_bytes()} for t in batch]
+                try:
+                    async with limiter:
+                        response = await model.generate_content_async([batch_prompt, *images])
+                except Exception as e:
+                    print(f"API Error for {names}: {e}")
+                    await asyncio.sleep(20) # Backoff
+                    return
 
             # Parse Response
-            detections = []
             try:
-                json_response = json.loads(response.text)
-                detections = json_response.get("detections", [])
+                tile_results = orjson.loads(response.text).get("tiles", [])
             except Exception as e:
-                print(f"Failed to parse response for {filename}: {e}")
-                continue
-
-            # Geotransform using Rasterio
-            with rasterio.open(tile_path) as src:
-                transform = src.transform
-                crs = src.crs
-            
-            # Convert to GeoJSON Features
-            for det in detections:
-                ymin_n, xmin_n, ymax_n, xmax_n = det["box_2d"]
-                
-                # Convert Normalized (0-1000) to Pixel Coords
-                # Note: TILE_SIZE is used, assuming tile is TILE_SIZE x TILE_SIZE
-                # We can also get width/height from 'src' if we wanted to be perfectly safe,
-                # but TILE_SIZE is constant.
-                
-                px_min_x = (xmin_n / 1000.0) * TILE_SIZE
-                px_max_x = (xmax_n / 1000.0) * TILE_SIZE
-                px_min_y = (ymin_n / 1000.0) * TILE_SIZE
-                px_max_y = (ymax_n / 1000.0) * TILE_SIZE
-                
-                # Convert Pixel to Geo using Affine Transform
-                # transform * (col, row) -> (x, y)
-                # Box corners:
-                # Top-Left Pixel (min_x, min_y) -> Geo (min_gx, max_gy) usually?
-                # Let's just transform all 4 corners or min/max.
-                
-                geo_x1, geo_y1 = transform * (px_min_x, px_min_y)
-                geo_x2, geo_y2 = transform * (px_max_x, px_max_y)
-                
-                # Since Y axis is inverted in pixels vs geo usually:
-                min_geo_x = min(geo_x1, geo_x2)
-                max_geo_x = max(geo_x1, geo_x2)
-                min_geo_y = min(geo_y1, geo_y2)
-                max_geo_y = max(geo_y1, geo_y2)
-                
-                geom = box(min_geo_x, min_geo_y, max_geo_x, max_geo_y)
-                
-                feature = geojson.Feature(
-                    geometry=mapping(geom),
-                    properties={
-                        "source_tile": filename,
-                        "label": det.get("label", "mound"),
-                        "reasoning": det.get("reasoning", ""),
-                        "confidence": "high"
-                    }
-                )
-                features.append(feature)
-
-            # Rate Limit Sleep
-            time.sleep(10)
-            
-            # Periodically save
-            if (i + 1) % save_frequency == 0:
-                collection = geojson.FeatureCollection(features)
-                if crs:
-                    collection["crs"] = {
-                        "type": "name",
+                print(f"Failed to parse response for {names}: {e}")
+                return
+
+            for tile_result in tile_results:
+                idx = tile_result.get("tile_idx")
+                if not isinstance(idx, int) or not 0 <= idx < len(batch):
+                    print(f"Ignoring result with invalid tile_idx {idx!r} for {names}")
+                    continue
+                detections = tile_result.get("detections", [])
+                if not detections:
+                    continue
+                filename = batch[idx].name
+
+                # Geotransform from the manifest written by preprocess_tiling.py
+                transform, epsg = tile_manifest[filename]
+                if epsg:
+                    last_epsg = epsg
+
+                # Convert to GeoJSON Features
+                new_features = []
+                bounds = boxes_to_geo([det["box_2d"] for det in detections], transform).tolist()
+                for det, (min_x, min_y, max_x, max_y) in zip(detections, bounds):
+                    # Built directly as a dict; ring follows shapely's box() vertex order
+                    new_features.append({
+                        "type": "Feature",
+                        "geometry": {
+                            "type": "Polygon",
+                            "coordinates": [[[max_x, min_y], [max_x, max_y], [min_x, max_y], [min_x, min_y], [max_x, min_y]]]
+                        },
                         "properties": {
-                            "name": f"urn:ogc:def:crs:EPSG::{crs.to_epsg()}"
+                            "source_tile": filename,
+                            "label": det.get("label", "mound"),
+                            "reasoning": det.get("reasoning", ""),
+                            "confidence": "high"
                         }
-                    }
-                with open(output_file, "w") as f:
-                    geojson.dump(collection, f)
+                    })
+
+                # Append to the stream: constant work per tile instead of re-dumping everything.
+                # No await between here and the append, so batches can't interleave lines.
+                with open(stream_file, "ab") as f:
+                    f.write(b"".join(orjson.dumps(feat) + b"\n" for feat in new_features))
+                feature_count += len(new_features)
 
         except Exception as e:
-            print(f"Error processing {filename}: {e}")
-            time.sleep(20)
+            print(f"Error processing {names}: {e}")
+        finally:
+            progress.update(len(batch))
+
+    batches = [tiles_to_process[i:i + TILES_PER_REQUEST] for i in range(0, len(tiles_to_process), TILES_PER_REQUEST)]
+    await asyncio.gather(*(process_batch(b) for b in batches))
+    progress.close()
 
-    # Final Save
-    collection = geojson.FeatureCollection(features)
-    # Use last valid CRS? Or default
-    collection["crs"] = {
+    # Final Save: assemble the FeatureCollection once, streaming the features
+    # straight from the .geojsonl rather than loading them all
+    # Use last valid CRS. Always write one: a GeoJSON without it is read back as EPSG:4326
+    if not last_epsg:
+        print(f"Warning: no CRS found for these tiles, assuming EPSG:{DEFAULT_EPSG}")
+    crs = {
         "type": "name",
         "properties": {
-            "name": "urn:ogc:def:crs:EPSG::32635" 
+            "name": f"urn:ogc:def:crs:EPSG::{last_epsg or DEFAULT_EPSG}"
         }
     }
-    with open(output_file, "w") as f:
-        geojson.dump(collection, f)
+    with open(stream_file, "rb") as src, open(output_file, "wb") as dst:
+        dst.write(b'{"type":"FeatureCollection","crs":' + orjson.dumps(crs) + b',"features":[')
+        for i, line in enumerate(src):
+            if i:
+                dst.write(b",")
+            dst.write(line.rstrip(b"\n"))
+        dst.write(b"]}")
         
-    print(f"Finished. Saved {len(features)} detections to {output_file}")
+    print(f"Finished. Saved {feature_count} detections to {output_file}")
 
 if __name__ == "__main__":
-    detect_mounds()
+    asyncio.run(detect_mounds())
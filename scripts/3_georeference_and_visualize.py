@@ -1,15 +1,41 @@
 
+import os
+
+# Must be set before pyproj loads: no remote PROJ grids are needed here, and lookups slow startup
+os.environ.setdefault("PROJ_NETWORK", "OFF")
+
 import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyogrio
+import shapely
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 from pathlib import Path
 import sys
 
 # Adjust python path
 sys.path.append(str(Path(__file__).parent.parent))
 from config import OUTPUTS_DIR, RESULTS_DIR
+from tile_utils import load_tile_manifests
+
+def source_epsg(gdf):
+    """
+    EPSG of the maps the detections came from, looked up via their source tiles
+    in the tile manifests (preprocess_tiling.py records src.crs there).
+    """
+    if "source_tile" not in gdf.columns:
+        return None
+    manifest = load_tile_manifests()
+    for tile in gdf["source_tile"].dropna().unique():
+        _, epsg = manifest.get(tile, (None, None))
+        if epsg:
+            return epsg
+    return None
 
 def deduplicate_detections(gdf, distance_threshold=20.0):
     """
-    Deduplicates points by buffering and merging.
+    Deduplicates points by clustering detections within the threshold of each other.
     """
     if gdf.empty:
         return gdf
@@ -17,29 +43,48 @@ def deduplicate_detections(gdf, distance_threshold=20.0):
     print(f"Deduplicating {len(gdf)} detections with {distance_threshold}m threshold...")
     
     # 1. Convert to centroids for clustering (boxes might overlap oddly)
-    #    Actually buffering the boxes themselves is fine too.
-    #    Let's buffer the centroids.
+    points = gdf.geometry.centroid.reset_index(drop=True)
     
-    # Ensure we use centroids for the location logic
-    points = gdf.geometry.centroid
-    buffered = points.buffer(distance_threshold / 2)
-    merged = buffered.unary_union
+    # 2. Find neighbouring points with a single STRtree query. Two buffers of
+    #    threshold/2 touch exactly when their centres are within threshold, so
+    #    no buffer polygons or GEOS overlay are needed
+    tree = shapely.STRtree(points.values)
+    left, right = tree.query(points.values, predicate="dwithin", distance=distance_threshold)
+    adjacency = csr_matrix((np.ones(len(left)), (left, right)), shape=(len(points), len(points)))
     
-    if merged.is_empty:
-        return gpd.GeoDataFrame(columns=gdf.columns, crs=gdf.crs)
-
-    final_points = []
-    if merged.geom_type == 'Polygon':
-        geoms = [merged]
-    elif merged.geom_type == 'MultiPolygon':
-        geoms = merged.geoms
-    else:
-        geoms = []
-
-    for geom in geoms:
-        final_points.append(geom.centroid)
-        
-    deduplicated_gdf = gpd.GeoDataFrame(geometry=final_points, crs=gdf.crs)
+    # 3. Chains of neighbours form one cluster (same grouping the union gave)
+    _, labels = connected_components(adjacency, directed=False)
+    
+    # 4. One point per cluster at the mean of its members' coordinates, plus how
+    #    many detections were merged into it
+    #    (per-label sums in one bincount pass each, no per-cluster Python loop)
+    n_detections = np.bincount(labels)
+    clusters = pd.DataFrame({
+        "x": np.bincount(labels, weights=points.x.to_numpy()) / n_detections,
+        "y": np.bincount(labels, weights=points.y.to_numpy()) / n_detections,
+        "n_detections": n_detections,
+    })
+    
+    # 5. Reattach attributes from one representative detection per cluster: the
+    #    first member carrying the cluster's most common label (ties -> first seen)
+    attributes = [column for column in ("label", "reasoning", "source_tile") if column in gdf.columns]
+    if attributes:
+        members = gdf[attributes].reset_index(drop=True)
+        members["cluster"] = labels
+        if "label" in attributes:
+            # dropna=False: a null label is a vote like any other, so all-null clusters survive
+            votes = members.groupby(["cluster", "label"], sort=False, dropna=False).size().rename("votes").reset_index()
+            modal = votes.sort_values(["cluster", "votes"], ascending=[True, False], kind="stable").drop_duplicates("cluster")
+            modal_label = members["cluster"].map(modal.set_index("cluster")["label"])
+            carries_modal = members["label"].eq(modal_label) | (members["label"].isna() & modal_label.isna())
+            members = members[carries_modal]
+        # Whole rows, so every attribute comes from the same detection
+        representatives = members.drop_duplicates("cluster").set_index("cluster")
+        clusters = clusters.join(representatives[attributes], how="left")
+        clusters = clusters[attributes + ["x", "y", "n_detections"]]
+    
+    final_points = gpd.points_from_xy(clusters.pop("x"), clusters.pop("y"), crs=gdf.crs)
+    deduplicated_gdf = gpd.GeoDataFrame(clusters.reset_index(drop=True), geometry=final_points, crs=gdf.crs)
     print(f"Reduced by {len(gdf) - len(deduplicated_gdf)} detections (Final: {len(deduplicated_gdf)})")
     return deduplicated_gdf
 
@@ -69,7 +114,7 @@ def process_results():
 
     print(f"Reading {input_file}...")
     try:
-        gdf = gpd.read_file(input_file)
+        gdf = gpd.read_file(input_file, engine="pyogrio", use_arrow=True)
     except Exception as e:
         print(f"Error reading GeoJSON: {e}")
         return
@@ -78,10 +123,12 @@ def process_results():
         print("No detections found within file.")
         return
 
-    # Ensure CRS is correct (it should be read from the file, but we can enforce if missing)
-    if gdf.crs is None:
-        print("Warning: CRS missing, assigning EPSG:32635")
-        gdf.set_crs(epsg=32635, inplace=True)
+    # Ensure CRS is correct. A file written without a crs member reads back as EPSG:4326,
+    # so check it against the source maps' CRS rather than only filling in a missing one
+    epsg = source_epsg(gdf)
+    if epsg and (gdf.crs is None or gdf.crs.to_epsg() != epsg):
+        print(f"Warning: file CRS is {gdf.crs}, but the source maps are EPSG:{epsg}; using EPSG:{epsg}")
+        gdf.set_crs(epsg=epsg, inplace=True, allow_override=True)
         
     print(f"Loaded {len(gdf)} raw detections.")
 
@@ -93,9 +140,20 @@ def process_results():
     output_filename = input_file.stem.replace("detections-", "mounds-") + ".gpkg"
     output_gpkg = RESULTS_DIR / output_filename
     
-    # Save Layers
-    gdf.to_file(output_gpkg, layer="raw_boxes", driver="GPKG")
-    deduped_gdf.to_file(output_gpkg, layer="deduped_points", driver="GPKG")
+    # The GeoPackage is rebuilt from scratch on every run (a stale or half-written
+    # file from an earlier run is removed first), so SQLite needn't fsync each write;
+    # a crash just means re-running this script
+    output_gpkg.unlink(missing_ok=True)
+    pyogrio.set_gdal_config_options({"OGR_SQLITE_SYNCHRONOUS": "OFF", "OGR_SQLITE_JOURNAL": "MEMORY"})
+    
+    # Save Layers (pyogrio bulk writes instead of the per-feature Fiona path),
+    # each with an R-tree so GIS queries on the GeoPackage stay fast
+    layer_options = {"SPATIAL_INDEX": "YES"}
+    # use_arrow hands the columns to OGR in bulk rather than feature by feature
+    pyogrio.write_dataframe(gdf, output_gpkg, layer="raw_boxes", driver="GPKG",
+                            layer_options=layer_options, use_arrow=True)
+    pyogrio.write_dataframe(deduped_gdf, output_gpkg, layer="deduped_points", driver="GPKG",
+                            layer_options=layer_options, use_arrow=True)
     
     print(f"Saved results to {output_gpkg}")
 
@@ -1,5 +1,10 @@
 
-import json
+import math
+import threading
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import pyarrow as pa
+import pyarrow.parquet as pq
 import rasterio
 from rasterio.windows import Window
 from PIL import Image
@@ -10,11 +15,11 @@ import numpy as np
 # Adjust python path if run as script, though standard import is better
 import sys
 sys.path.append(str(Path(__file__).parent.parent))
-from config import INPUTS_DIR, TILES_DIR, TILE_SIZE, OVERLAP
+from config import INPUTS_DIR, TILES_DIR, TILE_SIZE, OVERLAP, TILE_FORMAT, JPEG_QUALITY, WRITE_SIDECARS, TILING_WORKERS
 
 def tile_raster(input_path: Path):
     """
-    Tiles a GeoTIFF into smaller PNGs and saves metadata.
+    Tiles a GeoTIFF into smaller JPEGs/PNGs and saves a per-map tile manifest.
     """
     input_path = Path(input_path)
     map_name = input_path.stem
@@ -23,8 +28,6 @@ def tile_raster(input_path: Path):
     map_output_dir = TILES_DIR / map_name
     map_output_dir.mkdir(parents=True, exist_ok=True)
     
-    metadata = {}
-    
     with rasterio.open(input_path) as src:
         width = src.width
         height = src.height
@@ -32,6 +35,24 @@ def tile_raster(input_path: Path):
         # Calculate steps
         step = TILE_SIZE - OVERLAP
         
+        # Tiles are cut from full-width strips (one read per tile row), so only rows
+        # matter. A stripped source's few rows per strip cost next to nothing extra, but a
+        # tiled source whose block rows straddle the strips makes GDAL decode extra block
+        # rows for every strip. Warn so the input can be re-blocked.
+        block_h, block_w = src.block_shapes[0]
+        tiled = block_w < width
+        if tiled and (step % block_h or TILE_SIZE % block_h):
+            # Blocks below 256px cost more in per-block overhead than they save, so when no
+            # block that large fits the grid, recommend strips (what the reads walk anyway)
+            aligned_block = math.gcd(TILE_SIZE, step)
+            if aligned_block >= 256:
+                layout_options = f"-co TILED=YES -co BLOCKXSIZE={aligned_block} -co BLOCKYSIZE={aligned_block}"
+            else:
+                layout_options = "-co TILED=NO"
+            print(f"Warning: {input_path.name} is tiled with {block_w}x{block_h} blocks, "
+                  f"which the {TILE_SIZE}px/{step}px-step tile grid does not align to.")
+            print(f"  Re-block it first for faster tiling: gdal_translate {layout_options} {input_path.name} <output>.tif")
+        
         # Generate windows
         # Using a list comprehension for a cleaner progress bar setup
         windows = []
@@ -55,36 +76,90 @@ def tile_raster(input_path: Path):
                 windows.append((x, y, window))
 
         print(f"Processing {len(windows)} tiles for {map_name}...")
+
+        # Georeference every window at once: each tile's transform is the source
+        # transform shifted to its top-left pixel, so only the origin (c, f) varies
+        t = src.transform
+        cols = np.array([x for x, _, _ in windows], dtype=float)
+        rows = np.array([y for _, y, _ in windows], dtype=float)
+        tile_c = t.c + cols * t.a + rows * t.b
+        tile_f = t.f + cols * t.d + rows * t.e
+
+        # Shared by every tile, so format once
+        crs_wkt = src.crs.to_wkt()
+        # Minimal PAM XML
+        aux_xml_bytes = f"""<PAMDataset>
+  <SRS>{crs_wkt}</SRS>
+</PAMDataset>""".encode()
+        crs_epsg = src.crs.to_epsg()
         
-        for x, y, window in tqdm(windows):
-            # Read the data from the window
-            # boundless=True pads with 0 (black) if window is outside image
-            img_data = src.read(window=window, boundless=True, fill_value=0)
-            
-            # Rasterio reads as (Bands, Height, Width). Convert to (H, W, B) for Pillow
-            img_data = img_data.transpose(1, 2, 0)
-            
-            # If 1 band (grayscale), convert to RGB for consistency
-            if img_data.shape[2] == 1:
-                img_data = np.dstack([img_data]*3)
-            elif img_data.shape[2] > 3:
-                 # Drop alpha if present or take just first 3 bands
-                img_data = img_data[:, :, :3]
-                
-            # Create Image
-            img = Image.fromarray(img_data.astype('uint8'), 'RGB')
-            
-            # Filename
-            tile_filename = f"{map_name}_x{x}_y{y}.png"
-            tile_path = map_output_dir / tile_filename
-            img.save(tile_path)
-            
-            # --- SPATIAL METADATA REFACTOR ---
-            # 1. Get Transform for this specific window
-            # Rasterio returns transform for the window corner
-            window_transform = rasterio.windows.transform(window, src.transform)
-            
-            # 2. Write World File (.pgw)
+        # Single band stays grayscale ('L' tiles, a third of the pixels); extra bands (alpha) are dropped
+        band_indexes = [1] if src.count == 1 else [1, 2, 3]
+        mode = 'L' if src.count == 1 else 'RGB'
+
+    # World file extension convention: first + last letter of the image extension + "w"
+    world_file_suffix = f".{TILE_FORMAT[0]}{TILE_FORMAT[-1]}w"
+
+    # Windows are generated row by row, so each tile row is a contiguous run of
+    # n_cols windows that together span one strip of strip_width pixels
+    n_cols = len(range(0, width, step))
+    n_rows = len(windows) // n_cols
+    strip_width = (n_cols - 1) * step + TILE_SIZE
+
+    # Decode/encode release the GIL, so tile rows are written from a thread pool.
+    # A rasterio dataset handle must not be shared across threads: each worker
+    # opens its own on first use, along with a reusable uint8 strip buffer.
+    # The buffer is pixel-interleaved (H, W, B), the layout Pillow encodes from:
+    # rasterio reads into it through a (B, H, W) view, so no transpose copy is needed.
+    local = threading.local()
+    handles = []
+
+    def process_row(row):
+        src = getattr(local, "src", None)
+        if src is None:
+            src = local.src = rasterio.open(input_path)
+            # (one spare row: Pillow wants a full stride after the last row of the rightmost tile)
+            local.strip = np.empty((TILE_SIZE + 1, strip_width, len(band_indexes)), dtype='uint8')
+            handles.append(src)
+
+        # One read for the whole tile row instead of one per tile: each tile's
+        # overlap with its neighbours is decoded once, and the read covers whole blocks
+        # boundless=True pads with 0 (black) past the image edge
+        y = windows[row * n_cols][1]
+        src.read(indexes=band_indexes, out=local.strip[:TILE_SIZE].transpose(2, 0, 1), window=Window(0, y, strip_width, TILE_SIZE),
+                 boundless=True, fill_value=0)
+        return [process_window(row * n_cols + col, local.strip) for col in range(n_cols)]
+
+    def process_window(i, strip):
+        x, y, _ = windows[i]
+        out = strip[:TILE_SIZE, x:x + TILE_SIZE]
+        
+        # A single-colour window (padding past the map edge, black nodata collar, uniform
+        # coloured margin) has nothing for the VLM to find, so it is not written at all
+        if (out == out[0, 0]).all():
+            return None
+        
+        # Create Image straight from the strip: start at this tile's first pixel and
+        # step a whole strip row per image row, instead of copying the tile out first
+        bands = strip.shape[2]
+        img_data = memoryview(strip.reshape(-1))[x * bands:]
+        img = Image.frombuffer(mode, (TILE_SIZE, TILE_SIZE), img_data, 'raw', mode, strip_width * bands, 1)
+        
+        # Filename
+        tile_filename = f"{map_name}_x{x}_y{y}.{TILE_FORMAT}"
+        tile_path = map_output_dir / tile_filename
+        if TILE_FORMAT == "jpg":
+            # The VLM doesn't need lossless pixels; no chroma subsampling keeps thin symbols crisp.
+            # Pillow's wheels encode with libjpeg-turbo (SIMD), several times faster than PNG's zlib
+            img.save(tile_path, "JPEG", quality=JPEG_QUALITY, subsampling=0)
+        else:
+            # Fastest zlib level: ~3x quicker to encode for ~6% larger files, which the VLM doesn't mind
+            img.save(tile_path, compress_level=1)
+        
+        # --- SPATIAL METADATA ---
+        # 1. Transform for this specific window was precomputed above (it goes in the manifest)
+        if WRITE_SIDECARS:
+            # 2. Write World File (.pgw / .jgw)
             # Format: A, D, B, E, C, F
             # A: x-res, D: y-rot (0), B: x-rot (0), E: y-res (neg), C: x-center, F: y-center
             # window_transform gives Top-Left CORNER.
@@ -92,37 +167,60 @@ def tile_raster(input_path: Path):
             # CenterX = CornerX + (ResX / 2)
             # CenterY = CornerY + (ResY / 2)
             
-            res_x = window_transform.a
-            res_y = window_transform.e # usually negative
+            res_x = t.a
+            res_y = t.e # usually negative
             
-            center_x = window_transform.c + (res_x / 2.0)
-            center_y = window_transform.f + (res_y / 2.0)
+            center_x = tile_c[i] + (res_x / 2.0)
+            center_y = tile_f[i] + (res_y / 2.0)
             
             pgw_content = f"{res_x}\n0.0\n0.0\n{res_y}\n{center_x}\n{center_y}"
-            pgw_path = tile_path.with_suffix(".pgw")
-            with open(pgw_path, "w") as f:
-                f.write(pgw_content)
+            tile_path.with_suffix(world_file_suffix).write_bytes(pgw_content.encode())
                 
             # 3. Write CRS to .aux.xml (PAMDataset format) for complete compatibility
             # This allows QGIS/GDAL to recognize the CRS automatically.
-            aux_xml_path = tile_path.with_suffix(".png.aux.xml")
-            crs_wkt = src.crs.to_wkt()
-            # Minimal PAM XML
-            xml_content = f"""<PAMDataset>
-  <SRS>{crs_wkt}</SRS>
-</PAMDataset>"""
-            with open(aux_xml_path, "w") as f:
-                f.write(xml_content)
-
-            # Store legacy metadata just in case, but rely on sidecars now
-            w, s, e, n = rasterio.windows.bounds(window, src.transform)
-            metadata[tile_filename] = [w, s, src.res[0], src.res[1]]
- 
-    # Save legacy metadata as backup
-    with open(map_output_dir / "metadata.json", "w") as f:
-        json.dump(metadata, f, indent=2)
+            tile_path.with_name(tile_filename + ".aux.xml").write_bytes(aux_xml_bytes)
+
+        return tile_filename
+
+    try:
+        with ThreadPoolExecutor(max_workers=TILING_WORKERS) as executor:
+            filenames = []
+            with tqdm(total=len(windows)) as progress:
+                for row_filenames in executor.map(process_row, range(n_rows)):
+                    filenames.extend(row_filenames)
+                    progress.update(len(row_filenames))
+    finally:
+        for handle in handles:
+            handle.close()
+
+    # Drop the skipped blank windows from the manifest
+    written = np.array([tile_filename is not None for tile_filename in filenames], dtype=bool)
+    filenames = [tile_filename for tile_filename in filenames if tile_filename is not None]
+    tile_c, tile_f = tile_c[written], tile_f[written]
+
+    # One manifest per map (affine + CRS of every tile) instead of thousands of tiny sidecars
+    n_tiles = len(filenames)
+    manifest = pa.table({
+        "filename": filenames,
+        "a": np.full(n_tiles, t.a), "b": np.full(n_tiles, t.b), "c": tile_c,
+        "d": np.full(n_tiles, t.d), "e": np.full(n_tiles, t.e), "f": tile_f,
+        "crs_epsg": pa.array([crs_epsg] * n_tiles, type=pa.int32()),
+    })
+    pq.write_table(manifest, map_output_dir / "tiles.parquet")
         
-    print(f"Finished tiling {map_name}. Saved {len(windows)*3} files (png+pgw+aux) to {map_output_dir}")
+    files_per_tile = 3 if WRITE_SIDECARS else 1
+    print(f"Finished tiling {map_name}. Saved {n_tiles*files_per_tile} files + tiles.parquet to {map_output_dir} "
+          f"({len(windows) - n_tiles} blank tiles skipped)")
+
+def tile_map(tif_path: Path):
+    """
+    Tiles one map, reporting (rather than raising) errors so other maps carry on.
+    """
+    print(f"Starting {tif_path.name}...")
+    try:
+        tile_raster(tif_path)
+    except Exception as e:
+        print(f"Error processing {tif_path.name}: {e}")
 
 def main():
     # Process all TIFs in inputs
@@ -132,12 +230,16 @@ def main():
         print(f"No .tif files found in {INPUTS_DIR}")
         return
 
-    for tif_path in tif_files:
-        print(f"Starting {tif_path.name}...")
-        try:
-            tile_raster(tif_path)
-        except Exception as e:
-            print(f"Error processing {tif_path.name}: {e}")
+    # Maps are independent, so several are tiled at once in separate processes
+    # (each with its own TILING_WORKERS threads and GDAL handles)
+    max_workers = min(len(tif_files), max(1, (os.cpu_count() or 1) // TILING_WORKERS))
+    if max_workers == 1:
+        for tif_path in tif_files:
+            tile_map(tif_path)
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(tile_map, tif_files))
 
 if __name__ == "__main__":
     main()
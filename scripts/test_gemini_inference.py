@@ -1,17 +1,17 @@
 
 import os
-import json
+import orjson
 import random
 import time
 from pathlib import Path
 import google.generativeai as genai
-from PIL import Image
 from tqdm import tqdm
 
 # Adjust python path
 import sys
 sys.path.append(str(Path(__file__).parent.parent))
-from config import GOOGLE_API_KEY, MODEL_NAME, TILES_DIR, OUTPUTS_DIR
+from config import GOOGLE_API_KEY, MODEL_NAME, TILES_DIR, OUTPUTS_DIR, REQUESTS_PER_MINUTE
+from tile_utils import MIME_TYPES, iter_tiles
 
 def test_inference():
     # Configure Gemini
@@ -35,22 +35,28 @@ def test_inference():
     )
 
     # Gather all tiles
-    all_tiles = list(TILES_DIR.rglob("*.png"))
+    all_tiles = list(iter_tiles(TILES_DIR))
     if not all_tiles:
         print(f"No tiles found in {TILES_DIR}")
         return
 
     # Select 5 random tiles
-    selected_tiles = random.sample(all_tiles, min(5, len(all_tiles)))
+    selected_tiles = [Path(t) for t in random.sample(all_tiles, min(5, len(all_tiles)))]
     print(f"Selected {len(selected_tiles)} tiles for testing:")
     for t in selected_tiles:
         print(f" - {t.name}")
 
     results = {}
+    
+    # Rate limiting: requests are spaced from the start of the previous one, so time
+    # spent waiting on the API response counts towards the interval
+    min_interval = 60.0 / REQUESTS_PER_MINUTE
+    last_call = None
 
     for tile_path in tqdm(selected_tiles):
         try:
-            img = Image.open(tile_path)
+            # Raw file bytes: no decode here and no re-encode in the SDK
+            img = {"mime_type": MIME_TYPES[tile_path.suffix], "data": tile_path.read_bytes()}
             
             prompt = """
             Identify the bounding boxes of all 'Burial Mound' symbols in this map tile. 
@@ -65,28 +71,28 @@ def test_inference():
             If no mounds are found, return {"detections": []}.
             """
             
+            if last_call is not None:
+                wait = min_interval - (time.monotonic() - last_call)
+                if wait > 0:
+                    time.sleep(wait)
+            last_call = time.monotonic()
             response = model.generate_content([prompt, img])
             
             # Parse response
             try:
-                json_response = json.loads(response.text)
+                json_response = orjson.loads(response.text)
                 results[tile_path.name] = json_response
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 print(f"Failed to parse JSON for {tile_path.name}")
                 results[tile_path.name] = {"raw_text": response.text, "error": "JSONDecodeError"}
 
-            # Rate limiting safety
-            print("Sleeping for 10s to respect rate limits...")
-            time.sleep(10)
-
         except Exception as e:
             print(f"Error processing {tile_path.name}: {e}")
             results[tile_path.name] = {"error": str(e)}
 
     # Save results
     output_file = OUTPUTS_DIR / "test_detections.json"
-    with open(output_file, "w") as f:
-        json.dump(results, f, indent=2)
+    output_file.write_bytes(orjson.dumps(results, option=orjson.OPT_INDENT_2))
         
     print(f"\nTest detailed results saved to {output_file}")
     
@@ -0,0 +1,78 @@
+import os
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import orjson
+import pyarrow.parquet as pq
+from affine import Affine
+from rasterio.crs import CRS
+
+from config import TILES_DIR, TILE_SIZE
+
+# Tiles are uploaded as their encoded file bytes, so the SDK needs the type
+MIME_TYPES = {".jpg": "image/jpeg", ".png": "image/png"}
+TILE_SUFFIXES = tuple(MIME_TYPES)
+
+def iter_tiles(root):
+    """
+    Yields the path (str) of every tile image under root. os.scandir avoids the
+    per-entry stat + Path construction of rglob, which adds up over 10k+ tiles.
+    Any uploadable image type is matched, not just the current TILE_FORMAT, so
+    maps tiled under an earlier setting (e.g. the PNG sample tiles) are still found.
+    """
+    for entry in os.scandir(root):
+        if entry.is_dir(follow_symlinks=False):
+            yield from iter_tiles(entry.path)
+        elif entry.name.endswith(TILE_SUFFIXES):
+            yield entry.path
+
+def boxes_to_geo(boxes, transform):
+    """
+    Converts normalized (0-1000) [ymin, xmin, ymax, xmax] boxes to geo bounds.
+    Returns an (N, 4) array of [minx, miny, maxx, maxy].
+    """
+    # Normalized -> pixel coords (TILE_SIZE is constant across tiles)
+    px = np.asarray(boxes, dtype=float) / 1000.0 * TILE_SIZE
+    cols = px[:, [1, 3]]
+    rows = px[:, [0, 2]]
+
+    # transform * (col, row) -> (x, y), applied to both corners at once
+    geo_x = transform.a * cols + transform.b * rows + transform.c
+    geo_y = transform.d * cols + transform.e * rows + transform.f
+
+    # Y axis is inverted in pixels vs geo, so take min/max per box
+    return np.column_stack([geo_x.min(axis=1), geo_y.min(axis=1), geo_x.max(axis=1), geo_y.max(axis=1)])
+
+def legacy_epsg(map_dir):
+    """
+    EPSG of a legacy tile directory, parsed once from the SRS in any of its
+    per-tile .aux.xml sidecars (they all carry the map's CRS).
+    """
+    aux_path = next(map_dir.glob("*.aux.xml"), None)
+    if aux_path is None:
+        return None
+    srs = ET.parse(aux_path).getroot().findtext("SRS")
+    return CRS.from_wkt(srs).to_epsg() if srs else None
+
+def load_tile_manifests():
+    """
+    Loads every map's tiles.parquet (written by preprocess_tiling.py) into
+    {filename: (Affine, crs_epsg)}. Maps tiled before the manifest existed fall
+    back to their legacy metadata.json, with the CRS taken from one of the map's
+    .aux.xml sidecars (crs_epsg is None if there are none).
+    """
+    manifest = {}
+    for map_dir in TILES_DIR.iterdir():
+        manifest_path = map_dir / "tiles.parquet"
+        legacy_path = map_dir / "metadata.json"
+        if manifest_path.exists():
+            cols = pq.read_table(manifest_path).to_pydict()
+            rows = zip(cols["filename"], cols["a"], cols["b"], cols["c"], cols["d"], cols["e"], cols["f"], cols["crs_epsg"])
+            for filename, a, b, c, d, e, f, crs_epsg in rows:
+                manifest[filename] = (Affine(a, b, c, d, e, f), crs_epsg)
+        elif legacy_path.exists():
+            crs_epsg = legacy_epsg(map_dir)
+            # [LowerLeftX, LowerLeftY, ResX, ResY] -> north-up affine from the top-left corner
+            for filename, (ll_x, ll_y, res_x, res_y) in orjson.loads(legacy_path.read_bytes()).items():
+                manifest[filename] = (Affine(res_x, 0.0, ll_x, 0.0, -res_y, ll_y + TILE_SIZE * res_y), crs_epsg)
+    return manifest